@@ -1,17 +1,31 @@
 import uvicorn
 from fastapi import FastAPI, HTTPException, status, Body, Depends, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse
+import httpx
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from pydantic import BaseModel, Field, field_validator, ConfigDict
-from typing import List, Optional, Any, Dict
+from pydantic import BaseModel, Field, field_validator, ConfigDict, AfterValidator, BeforeValidator, PlainSerializer
+from typing import List, Optional, Any, Dict, AsyncIterator, Callable, Annotated
+import orjson
 import os
+import re
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 import datetime
 from contextlib import asynccontextmanager
 import asyncio
 import logging
+import time
 from datetime import timedelta
 
+try:
+    from celery import Celery
+    from celery.result import AsyncResult
+except ImportError:  # Celery is only needed when broadcasts run on a worker (REDIS_URL set)
+    Celery = None
+
 # --- Configuration ---
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,6 +34,22 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 MONGO_URI = os.environ.get("MONGO_URI","mongodb://localhost:27017")
 MONGO_DB_NAME = os.environ.get("MONGO_DB_NAME", "chatflow_ai")
 CLIENT_ORIGIN = os.environ.get("CLIENT_ORIGIN") # e.g., "http://localhost:5173"
+# Broadcasts stream contacts in batches and send concurrently, capped by the semaphore size
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "100"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+# Broker/result backend for the broadcast worker; without it broadcasts run in-process
+REDIS_URL = os.environ.get("REDIS_URL")
+# WhatsApp Cloud API endpoint (e.g. "https://graph.facebook.com/v19.0/<phone-number-id>");
+# when unset, sends are mocked
+WHATSAPP_API_URL = os.environ.get("WHATSAPP_API_URL")
+WHATSAPP_API_TOKEN = os.environ.get("WHATSAPP_API_TOKEN")
+# Message logs are queued and written in batches of up to N docs / every N seconds. Unflushed logs
+# are only visible to the worker process that queued them, so another worker's AI history can lag
+# by up to LOG_FLUSH_INTERVAL.
+LOG_FLUSH_BATCH_SIZE = int(os.environ.get("LOG_FLUSH_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "1.0"))
+# Seconds the webhook may serve the active flow from memory before re-reading it
+ACTIVE_FLOW_CACHE_TTL = float(os.environ.get("ACTIVE_FLOW_CACHE_TTL", "30"))
 
 # Validate required environment variables
 if not MONGO_URI:
@@ -27,15 +57,117 @@ if not MONGO_URI:
     raise ValueError("FATAL: MONGO_URI environment variable is not set.")
 if not CLIENT_ORIGIN:
     logging.warning("CLIENT_ORIGIN is not set. Defaulting to allow all (*).")
+if REDIS_URL and Celery is None:
+    logging.error("FATAL: REDIS_URL is set but celery is not installed.")
+    raise ValueError("FATAL: REDIS_URL is set but celery is not installed.")
+if not REDIS_URL:
+    logging.warning("REDIS_URL is not set. Broadcasts will run inside the API process.")
 
 # --- Global App State ---
-app_state = {}
+app_state = {
+    "active_flow_cache": {"data": None, "index": None, "expires": 0.0, "version": 0},
+    "active_flow_lock": asyncio.Lock(),
+    "log_queue": asyncio.Queue(),
+    # contact_id -> queued or in-flight message logs not yet written, oldest first
+    "pending_logs": {},
+}
+
+def create_whatsapp_http_client() -> httpx.AsyncClient:
+    """Creates the shared keep-alive (HTTP/2) client for outbound WhatsApp sends."""
+    headers = {"Authorization": f"Bearer {WHATSAPP_API_TOKEN}"} if WHATSAPP_API_TOKEN else None
+    return httpx.AsyncClient(
+        base_url=WHATSAPP_API_URL,
+        http2=True,
+        timeout=10,
+        headers=headers,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+    )
+
+async def ensure_indexes(db: AsyncIOMotorDatabase):
+    """Creates the indexes backing the hot query paths (idempotent).
+
+    Each index is built independently so one failure doesn't skip the rest. The unique
+    phone_number index is built last and is fatal: create_contact relies on it to reject
+    duplicates.
+    """
+    indexes = [
+        (db.contacts, "tags"),
+        (db.flows, "is_active"),
+        (db.message_logs, [("contact_id", 1), ("timestamp", -1)]),
+        (db.message_logs, [("direction", 1), ("timestamp", -1)]),
+        (db.message_logs, "timestamp"),
+    ]
+    for collection, keys in indexes:
+        try:
+            await collection.create_index(keys)
+        except PyMongoError as e:
+            logging.error(f"Failed to create index {keys} on {collection.name}: {e}")
+    try:
+        await db.contacts.create_index("phone_number", unique=True)
+    except PyMongoError as e:
+        logging.critical(
+            f"FATAL: Could not create the unique index on contacts.phone_number "
+            f"(duplicate phone numbers must be merged first): {e}"
+        )
+        raise RuntimeError("FATAL: unique index on contacts.phone_number is missing.") from e
+
+def forget_pending_logs(logs: List[Dict[str, Any]]):
+    """Drops written (or discarded) logs from the per-contact pending index."""
+    pending_logs = app_state["pending_logs"]
+    for log in logs:
+        contact_logs = pending_logs.get(log["contact_id"])
+        if contact_logs is None:
+            continue
+        contact_logs[:] = [pending for pending in contact_logs if pending is not log]
+        if not contact_logs:
+            del pending_logs[log["contact_id"]]
+
+async def run_message_log_flusher(db: AsyncIOMotorDatabase):
+    """Drains the log queue into message_logs in batches.
+
+    Writes are acknowledged: a log only leaves the pending index once Mongo has applied it,
+    so get_chat_history never falls into a gap between the two.
+    """
+    queue = app_state["log_queue"]
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = []
+        try:
+            batch.append(await queue.get())
+            deadline = loop.time() + LOG_FLUSH_INTERVAL
+            while len(batch) < LOG_FLUSH_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            # Also runs on shutdown (cancellation) so the batch in hand is not lost
+            if batch:
+                try:
+                    await db.message_logs.insert_many(batch, ordered=False, bypass_document_validation=True)
+                except PyMongoError as e:
+                    logging.error(f"Failed to flush {len(batch)} message logs: {e}")
+                forget_pending_logs(batch)
+
+async def drain_message_log_queue(db: AsyncIOMotorDatabase):
+    """Writes whatever is left in the log queue, used on shutdown."""
+    queue = app_state["log_queue"]
+    remaining = []
+    while not queue.empty():
+        remaining.append(queue.get_nowait())
+    if remaining:
+        logging.info(f"Flushing {len(remaining)} queued message logs...")
+        await db.message_logs.insert_many(remaining, ordered=False, bypass_document_validation=True)
+        forget_pending_logs(remaining)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage application startup and shutdown events."""
     logging.info("Connecting to MongoDB...")
-    app_state["mongo_client"] = AsyncIOMotorClient(MONGO_URI)
+    app_state["mongo_client"] = AsyncIOMotorClient(MONGO_URI, tz_aware=True)
     try:
         await app_state["mongo_client"].admin.command('ping')
         logging.info("Successfully connected to MongoDB.")
@@ -43,12 +175,58 @@ async def lifespan(app: FastAPI):
         logging.error(f"Failed to connect to MongoDB: {e}")
         app_state["mongo_client"] = None
     
+    app_state["supports_transactions"] = False
+    if app_state.get("mongo_client"):
+        # Transactions need a replica set (setName) or a sharded cluster (mongos)
+        try:
+            hello = await app_state["mongo_client"].admin.command('hello')
+            app_state["supports_transactions"] = "setName" in hello or hello.get("msg") == "isdbgrid"
+        except PyMongoError as e:
+            logging.warning(f"Could not detect MongoDB transaction support: {e}")
+        if not app_state["supports_transactions"]:
+            logging.warning("MongoDB transactions unavailable; flow activation will run without a transaction.")
+    
+    if app_state.get("mongo_client"):
+        await ensure_indexes(app_state["mongo_client"][MONGO_DB_NAME])
+        logging.info("MongoDB indexes are in place.")
+        app_state["log_flusher"] = asyncio.create_task(
+            run_message_log_flusher(app_state["mongo_client"][MONGO_DB_NAME])
+        )
+    
+    if WHATSAPP_API_URL:
+        app_state["http"] = create_whatsapp_http_client()
+    
     yield
     
+    if app_state.get("http"):
+        await app_state.pop("http").aclose()
+    
+    if app_state.get("log_flusher"):
+        app_state["log_flusher"].cancel()
+        try:
+            await app_state["log_flusher"]
+        except asyncio.CancelledError:
+            pass
+        await drain_message_log_queue(app_state["mongo_client"][MONGO_DB_NAME])
+    
     if app_state.get("mongo_client"):
         logging.info("Closing MongoDB connection...")
         app_state["mongo_client"].close()
 
+@asynccontextmanager
+async def transaction_session():
+    """Yields a session inside a transaction, or None when the deployment can't run transactions."""
+    if not app_state.get("supports_transactions"):
+        yield None
+        return
+    async with await app_state["mongo_client"].start_session() as session:
+        async with session.start_transaction():
+            yield session
+
+def get_http_client() -> Optional[httpx.AsyncClient]:
+    """Dependency injection for the shared WhatsApp HTTP client (None when sends are mocked)."""
+    return app_state.get("http")
+
 def get_database() -> AsyncIOMotorDatabase:
     """Dependency injection for the database."""
     client = app_state.get("mongo_client")
@@ -60,30 +238,46 @@ def get_database() -> AsyncIOMotorDatabase:
 
 # --- Pydantic Models ---
 
-class PyObjectId(ObjectId):
-    @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
-    @classmethod
-    def validate(cls, v, *args, **kwargs):
-        if not ObjectId.is_valid(v):
-            raise ValueError("Invalid ObjectId")
-        return ObjectId(v)
-    @classmethod
-    def __json_encoder__(cls, v):
-        return str(v)
+def utc_now() -> datetime.datetime:
+    """Timezone-aware replacement for the deprecated datetime.utcnow()."""
+    return datetime.datetime.now(datetime.UTC)
+
+def validate_object_id(v: Any) -> ObjectId:
+    """Coerces a str/ObjectId into an ObjectId, passing real ObjectIds straight through."""
+    if isinstance(v, ObjectId):
+        return v
+    if not ObjectId.is_valid(v):
+        raise ValueError("Invalid ObjectId")
+    return ObjectId(v)
+
+# Stays an ObjectId in Python (so it can be used in queries) and serializes to str in JSON
+PyObjectId = Annotated[
+    ObjectId,
+    BeforeValidator(validate_object_id),
+    PlainSerializer(str, return_type=str, when_used="json"),
+]
+
+PHONE_NUMBER_RE = re.compile(r"^\+?[1-9]\d{1,14}$")
+
+def validate_phone_number(v: str) -> str:
+    """Checks an E.164-style phone number against the precompiled pattern."""
+    if not PHONE_NUMBER_RE.fullmatch(v):
+        raise ValueError("Invalid phone number")
+    return v
+
+# Only used where user input arrives; documents read back from Mongo are trusted
+PhoneNumber = Annotated[str, AfterValidator(validate_phone_number)]
 
 class Contact(BaseModel):
-    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    id: PyObjectId = Field(default_factory=ObjectId, alias="_id")
     name: str = Field(..., min_length=1)
-    phone_number: str = Field(..., pattern=r"^\+?[1-9]\d{1,14}$")
+    phone_number: str
     tags: List[str] = []
     current_flow_node_id: Optional[str] = None
-    last_active: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
+    last_active: datetime.datetime = Field(default_factory=utc_now)
     
     model_config = ConfigDict(
         arbitrary_types_allowed=True,
-        json_encoders={ObjectId: str},
         populate_by_name=True
     )
 
@@ -92,18 +286,17 @@ class ContactInDB(Contact):
 
 class ContactCreate(BaseModel):
     name: str = Field(..., min_length=1)
-    phone_number: str
+    phone_number: PhoneNumber
     tags: List[str] = []
 
 class ChatbotFlow(BaseModel):
-    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    id: PyObjectId = Field(default_factory=ObjectId, alias="_id")
     name: str
     flow_data: dict = Field(..., default_factory=dict)
     is_active: bool = False
     
     model_config = ConfigDict(
         arbitrary_types_allowed=True,
-        json_encoders={ObjectId: str},
         populate_by_name=True
     )
 
@@ -121,19 +314,23 @@ class ChatbotFlowUpdate(BaseModel):
     is_active: Optional[bool] = None
 
 class MessageLog(BaseModel):
-    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    id: PyObjectId = Field(default_factory=ObjectId, alias="_id")
     contact_id: PyObjectId
     from_number: str
     direction: str # "inbound" or "outbound"
     text: str
-    timestamp: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
+    timestamp: datetime.datetime = Field(default_factory=utc_now)
     
     model_config = ConfigDict(
         arbitrary_types_allowed=True,
-        json_encoders={ObjectId: str},
         populate_by_name=True
     )
 
+def construct_from_db(model: type[BaseModel], doc: Dict[str, Any]) -> BaseModel:
+    """Builds a model from a trusted Mongo document without re-running validation."""
+    fields = {k: v for k, v in doc.items() if k != "_id"}
+    return model.model_construct(id=doc["_id"], **fields)
+
 # --- Dashboard Pydantic Models ---
 class ChartDataPoint(BaseModel):
     """Data point for the 7-day chart."""
@@ -159,42 +356,133 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
+# --- Compression Middleware ---
+# JSON list/dashboard payloads compress well; small responses are left alone
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # --- CORS Middleware ---
-if CLIENT_ORIGIN:
-    app.add_middleware(
-        CORSMiddleware,
-        allow_origins=[CLIENT_ORIGIN],
-        allow_credentials=True,
-        allow_methods=["GET", "POST", "PUT", "DELETE"],
-        allow_headers=["*"],
-    )
-else:
+if not CLIENT_ORIGIN:
     logging.warning("CORS is configured to allow all origins. DO NOT run in production.")
-    app.add_middleware(
-        CORSMiddleware,
-        allow_origins=["*"],
-        allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=[CLIENT_ORIGIN] if CLIENT_ORIGIN else ["*"],
+    allow_credentials=True,
+    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
+    max_age=86400,
+)
+
+# --- Serialization Helpers ---
+
+def contact_to_json(contact: Dict[str, Any]) -> Dict[str, Any]:
+    """Converts a raw contact document into a JSON-ready dict (keeps the `_id` key)."""
+    return {**contact, "_id": str(contact["_id"])}
+
+def flow_to_json(flow: Dict[str, Any]) -> Dict[str, Any]:
+    """Converts a raw flow document into a JSON-ready dict exposing `id`."""
+    flow_json = {k: v for k, v in flow.items() if k != "_id"}
+    flow_json["id"] = str(flow["_id"])
+    return flow_json
+
+def orjson_response(content: Any, status_code: int = status.HTTP_200_OK) -> Response:
+    """Encodes an already JSON-ready payload with orjson, skipping FastAPI's encoder."""
+    return Response(
+        orjson.dumps(content, option=orjson.OPT_UTC_Z),
+        status_code=status_code,
+        media_type="application/json",
     )
 
+async def stream_json_array(cursor, serialize: Callable[[Dict[str, Any]], Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Yields a Motor cursor as a JSON array, one encoded document at a time."""
+    yield b"["
+    first = True
+    async for doc in cursor:
+        if not first:
+            yield b","
+        first = False
+        # OPT_UTC_Z renders UTC as "Z", matching the Pydantic-serialized responses
+        yield orjson.dumps(serialize(doc), option=orjson.OPT_UTC_Z)
+    yield b"]"
+
+# --- Active Flow Cache ---
+
+def build_flow_index(flow_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Precomputes O(1) lookups over a flow's nodes and edges."""
+    nodes = flow_data.get('nodes', [])
+    edges = flow_data.get('edges', [])
+    next_of = {}
+    for edge in edges:
+        # The first outgoing edge of a node wins, as with the original linear scan
+        next_of.setdefault(edge.get('source'), edge.get('target'))
+    target_nodes = {edge.get('target') for edge in edges}
+    return {
+        "nodes_by_id": {n.get('id'): n for n in nodes},
+        "next_of": next_of,
+        "trigger": next((n for n in nodes if n.get('id') not in target_nodes), None),
+    }
+
+async def get_active_flow(db: AsyncIOMotorDatabase) -> tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Returns the active flow and its lookup index, re-reading Mongo at most once per TTL."""
+    cache = app_state["active_flow_cache"]
+    if time.monotonic() < cache["expires"]:
+        return cache["data"], cache["index"]
+    async with app_state["active_flow_lock"]:
+        # Another request may have refreshed the cache while we waited
+        if time.monotonic() < cache["expires"]:
+            return cache["data"], cache["index"]
+        version = cache["version"]
+        active_flow = await db.flows.find_one({"is_active": True})
+        flow_index = build_flow_index(active_flow.get('flow_data', {})) if active_flow else None
+        # Don't cache a read that raced with a flow mutation
+        if cache["version"] == version:
+            cache["data"] = active_flow
+            cache["index"] = flow_index
+            cache["expires"] = time.monotonic() + ACTIVE_FLOW_CACHE_TTL
+        return active_flow, flow_index
+
+def invalidate_active_flow_cache():
+    """Forces the next webhook to re-read the active flow."""
+    cache = app_state["active_flow_cache"]
+    cache["version"] += 1
+    cache["expires"] = 0.0
+
 # --- Utility Functions (MOCKED) ---
 
-async def log_message(db: AsyncIOMotorDatabase, contact_id: ObjectId, from_number: str, direction: str, text: str):
-    """Logs a message to the database."""
+def build_message_log(
+    contact_id: ObjectId, from_number: str, direction: str, text: str, timestamp: datetime.datetime
+) -> Dict[str, Any]:
+    """Builds a message log document ready for insertion."""
     log = MessageLog(
         contact_id=contact_id,
         from_number=from_number,
         direction=direction,
-        text=text
+        text=text,
+        timestamp=timestamp
     )
-    await db.message_logs.insert_one(log.model_dump(by_alias=True))
-
-async def send_whatsapp_reply(phone_number: str, text: str):
-    """MOCKED function to send a reply via WhatsApp."""
-    logging.info(f"--- MOCKED WHATSAPP SEND --- TO: {phone_number} BODY: {text}")
-    await asyncio.sleep(0.1)
-    pass
+    return log.model_dump(by_alias=True)
+
+def log_message(
+    contact_id: ObjectId, from_number: str, direction: str, text: str, timestamp: datetime.datetime
+) -> Dict[str, Any]:
+    """Queues a message log for the background flusher and returns the queued document."""
+    log = build_message_log(contact_id, from_number, direction, text, timestamp)
+    app_state["pending_logs"].setdefault(contact_id, []).append(log)
+    app_state["log_queue"].put_nowait(log)
+    return log
+
+async def send_whatsapp_reply(http: Optional[httpx.AsyncClient], phone_number: str, text: str):
+    """Sends a reply via the WhatsApp API over the given client (MOCKED when no client is given)."""
+    if http is None:
+        logging.info(f"--- MOCKED WHATSAPP SEND --- TO: {phone_number} BODY: {text}")
+        await asyncio.sleep(0.1)
+        return
+    response = await http.post("/messages", json={
+        "messaging_product": "whatsapp",
+        "to": phone_number,
+        "type": "text",
+        "text": {"body": text}
+    })
+    response.raise_for_status()
 
 async def get_openai_response(prompt: str, history: List[Dict[str, str]]) -> str:
     """MOCKED function to get a response from OpenAI."""
@@ -203,16 +491,51 @@ async def get_openai_response(prompt: str, history: List[Dict[str, str]]) -> str
     return f"This is a mocked AI response to your prompt: '{prompt or '...'}'"
 
 async def get_chat_history(db: AsyncIOMotorDatabase, contact_id: ObjectId, limit: int = 10) -> List[Dict[str, str]]:
-    """Retrieves the last N messages for a contact to use as AI context."""
-    history = []
-    cursor = db.message_logs.find({"contact_id": contact_id}).sort("timestamp", -1).limit(limit)
-    async for log in cursor:
-        role = "user" if log['direction'] == 'inbound' else 'assistant'
-        history.append({"role": role, "content": log['text']})
-    return history[::-1]
-
-async def execute_flow_node(db: AsyncIOMotorDatabase, contact: Contact, node: Dict, flow_data: Dict):
+    """Retrieves the last N messages for a contact to use as AI context.
+
+    Logs this process has queued but not yet flushed (the current inbound message, the
+    bot's previous reply) are merged in. Logs queued by another worker process are not
+    visible until that worker flushes them, up to LOG_FLUSH_INTERVAL later.
+    """
+    if limit < 1:
+        return []
+    pending = list(app_state["pending_logs"].get(contact_id, ()))
+    match = {"contact_id": contact_id}
+    if pending:
+        # A log may be both written and still pending while its flush is finishing
+        match["_id"] = {"$nin": [log["_id"] for log in pending]}
+    # Take the newest N via the (contact_id, timestamp) index, then return them oldest-first
+    # already shaped as chat messages
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"timestamp": -1}},
+        {"$limit": limit},
+        {"$sort": {"timestamp": 1}},
+        {
+            "$project": {
+                "_id": 0,
+                "role": {"$cond": [{"$eq": ["$direction", "inbound"]}, "user", "assistant"]},
+                "content": "$text"
+            }
+        }
+    ]
+    history = await db.message_logs.aggregate(pipeline).to_list(length=limit)
+    # The queue is flushed in order, so pending logs are newer than anything already written
+    history.extend(
+        {"role": "user" if log["direction"] == "inbound" else "assistant", "content": log["text"]}
+        for log in pending
+    )
+    return history[-limit:]
+
+async def execute_flow_node(
+    db: AsyncIOMotorDatabase,
+    http: Optional[httpx.AsyncClient],
+    contact: Contact,
+    node: Dict,
+    flow_index: Dict
+):
     """Executes a single node in the flow and finds the next node."""
+    now = utc_now()
     node_type = node.get('type')
     node_id = node.get('id')
     current_node_id = contact.current_flow_node_id
@@ -228,22 +551,34 @@ async def execute_flow_node(db: AsyncIOMotorDatabase, contact: Contact, node: Di
         prompt = node.get('data', {}).get('prompt', '')
         reply_text = await get_openai_response(prompt, history)
 
-    if reply_text:
-        await send_whatsapp_reply(contact.phone_number, reply_text)
-        await log_message(db, contact.id, contact.phone_number, "outbound", reply_text)
-    
-    next_node_id = None
-    edges = flow_data.get('edges', [])
-    for edge in edges:
-        if edge.get('source') == node_id:
-            next_node_id = edge.get('target')
-            break
+    next_node_id = flow_index["next_of"].get(node_id)
             
     logging.info(f"Updating contact {contact.id} state: {current_node_id} -> {next_node_id}")
-    await db.contacts.update_one(
+    async def send_and_log():
+        # Only a reply that was actually sent is logged as outbound
+        await send_whatsapp_reply(http, contact.phone_number, reply_text)
+        log_message(contact.id, contact.phone_number, "outbound", reply_text, now)
+
+    state_update = db.contacts.update_one(
         {"_id": contact.id},
-        {"$set": {"current_flow_node_id": next_node_id, "last_active": datetime.datetime.utcnow()}}
+        {"$set": {"current_flow_node_id": next_node_id, "last_active": now}}
     )
+    if not reply_text:
+        await state_update
+        return
+
+    # The reply and the state update are independent; run them concurrently
+    state_result, send_result = await asyncio.gather(state_update, send_and_log(), return_exceptions=True)
+    if isinstance(send_result, Exception):
+        if not isinstance(state_result, Exception):
+            # Undo the advance so a retried delivery re-runs this node instead of skipping its reply
+            await db.contacts.update_one(
+                {"_id": contact.id, "current_flow_node_id": next_node_id},
+                {"$set": {"current_flow_node_id": current_node_id}}
+            )
+        raise send_result
+    if isinstance(state_result, Exception):
+        raise state_result
 
 # --- API Endpoints ---
 
@@ -254,100 +589,180 @@ async def root():
 # --- Contacts Endpoints ---
 @app.post("/api/contacts", response_model=ContactInDB, status_code=status.HTTP_201_CREATED)
 async def create_contact(contact: ContactCreate, db: AsyncIOMotorDatabase = Depends(get_database)):
-    existing_contact = await db.contacts.find_one({"phone_number": contact.phone_number})
-    if existing_contact:
-        raise HTTPException(status_code=400, detail="Contact with this phone number already exists.")
     contact_dict = contact.model_dump()
     contact_dict['current_flow_node_id'] = None
-    contact_dict['last_active'] = datetime.datetime.utcnow()
+    contact_dict['last_active'] = utc_now()
     
-    new_contact = await db.contacts.insert_one(contact_dict)
-    created_contact = await db.contacts.find_one({"_id": new_contact.inserted_id})
-    if created_contact is None:
-        raise HTTPException(status_code=500, detail="Failed to create and retrieve contact.")
-    return ContactInDB(**created_contact)
+    # The unique index on phone_number rejects duplicates atomically
+    try:
+        new_contact = await db.contacts.insert_one(contact_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Contact with this phone number already exists.")
+    contact_dict['_id'] = new_contact.inserted_id
+    return construct_from_db(ContactInDB, contact_dict)
 
-@app.get("/api/contacts", response_model=List[ContactInDB])
+@app.get("/api/contacts")
 async def get_all_contacts(db: AsyncIOMotorDatabase = Depends(get_database)):
-    contacts = []
-    async for contact in db.contacts.find():
-        contacts.append(ContactInDB(**contact))
-    return contacts
+    cursor = db.contacts.find().batch_size(500)
+    return StreamingResponse(stream_json_array(cursor, contact_to_json), media_type="application/json")
 
 # --- Chatbot Flow Endpoints ---
-@app.post("/api/flows", response_model=ChatbotFlowInDB, status_code=status.HTTP_201_CREATED)
+@app.post("/api/flows", status_code=status.HTTP_201_CREATED)
 async def create_flow(flow: ChatbotFlowCreate, db: AsyncIOMotorDatabase = Depends(get_database)):
     flow_dict = flow.model_dump()
-    if flow.is_active:
-        await db.flows.update_many({"is_active": True}, {"$set": {"is_active": False}})
-    new_flow = await db.flows.insert_one(flow_dict)
-    created_flow = await db.flows.find_one({"_id": new_flow.inserted_id})
-    return ChatbotFlowInDB(**created_flow)
-
-@app.get("/api/flows", response_model=List[ChatbotFlowInDB])
+    # Insert first, then deactivate the others, so there is never a moment with no active flow
+    async with transaction_session() as session:
+        new_flow = await db.flows.insert_one(flow_dict, session=session)
+        if flow.is_active:
+            await db.flows.update_many(
+                {"_id": {"$ne": new_flow.inserted_id}, "is_active": True},
+                {"$set": {"is_active": False}},
+                session=session
+            )
+    invalidate_active_flow_cache()
+    flow_dict['_id'] = new_flow.inserted_id
+    return orjson_response(flow_to_json(flow_dict), status_code=status.HTTP_201_CREATED)
+
+@app.get("/api/flows")
 async def get_all_flows(db: AsyncIOMotorDatabase = Depends(get_database)):
-    flows = []
-    async for flow in db.flows.find():
-        flows.append(ChatbotFlowInDB(**flow))
-    return flows
+    cursor = db.flows.find().batch_size(500)
+    return StreamingResponse(stream_json_array(cursor, flow_to_json), media_type="application/json")
 
-@app.get("/api/flows/{id}", response_model=ChatbotFlowInDB)
+@app.get("/api/flows/{id}")
 async def get_flow(id: str, db: AsyncIOMotorDatabase = Depends(get_database)):
     if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid flow ID")
     flow = await db.flows.find_one({"_id": ObjectId(id)})
     if flow is None:
         raise HTTPException(status_code=404, detail="Flow not found")
-    return ChatbotFlowInDB(**flow)
+    return orjson_response(flow_to_json(flow))
 
-@app.put("/api/flows/{id}", response_model=ChatbotFlowInDB)
+@app.put("/api/flows/{id}")
 async def update_flow(id: str, flow_update: ChatbotFlowUpdate, db: AsyncIOMotorDatabase = Depends(get_database)):
     if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid flow ID")
     update_data = flow_update.model_dump(exclude_unset=True)
     if not update_data:
         raise HTTPException(status_code=400, detail="No update data provided.")
-    if update_data.get("is_active"):
-        await db.flows.update_many({"_id": {"$ne": ObjectId(id)}, "is_active": True}, {"$set": {"is_active": False}})
-    result = await db.flows.update_one({"_id": ObjectId(id)}, {"$set": update_data})
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Flow not found")
-    updated_flow = await db.flows.find_one({"_id": ObjectId(id)})
-    return ChatbotFlowInDB(**updated_flow)
+    # Update first, then deactivate the others, so there is never a moment with no active flow
+    async with transaction_session() as session:
+        updated_flow = await db.flows.find_one_and_update(
+            {"_id": ObjectId(id)},
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if updated_flow is None:
+            raise HTTPException(status_code=404, detail="Flow not found")
+        if update_data.get("is_active"):
+            await db.flows.update_many(
+                {"_id": {"$ne": ObjectId(id)}, "is_active": True},
+                {"$set": {"is_active": False}},
+                session=session
+            )
+    invalidate_active_flow_cache()
+    return orjson_response(flow_to_json(updated_flow))
 
 # --- Broadcast Endpoint ---
 class BroadcastRequest(BaseModel):
     message: str
     tags: List[str] = []
 
-async def run_broadcast_task(db: AsyncIOMotorDatabase, message: str, tags: List[str]):
-    """The actual background task for sending messages."""
+async def run_broadcast_task(
+    db: AsyncIOMotorDatabase, http: Optional[httpx.AsyncClient], message: str, tags: List[str]
+):
+    """The actual background task for sending messages.
+
+    Contacts are streamed in batches; each batch is sent concurrently (bounded
+    by a semaphore) and its logs are written with a single insert_many.
+    """
     query = {}
     if tags:
         query = {"tags": {"$in": tags}}
     total_sent = 0
-    contacts_cursor = db.contacts.find(query)
-    
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    broadcast_text = f"[BROADCAST] {message}"
+
+    async def bounded_send(contact: Dict, timestamp: datetime.datetime) -> Optional[Dict[str, Any]]:
+        async with semaphore:
+            try:
+                await send_whatsapp_reply(http, contact["phone_number"], message)
+            except Exception as e:
+                logging.error(f"Failed to send broadcast to {contact['phone_number']}: {e}")
+                return None
+        return build_message_log(contact["_id"], contact["phone_number"], "outbound", broadcast_text, timestamp)
+
+    async def send_batch(batch: List[Dict]) -> int:
+        # All logs of one batch share a timestamp
+        now = utc_now()
+        results = await asyncio.gather(*(bounded_send(contact, now) for contact in batch))
+        logs = [log for log in results if log is not None]
+        if logs:
+            # The messages are already out; a failed log write must not abort the rest of the broadcast
+            try:
+                await db.message_logs.insert_many(logs, ordered=False, bypass_document_validation=True)
+            except BulkWriteError as e:
+                lost = len(logs) - e.details.get("nInserted", 0)
+                logging.error(f"Failed to log {lost} of {len(logs)} broadcast messages: {e}")
+            except PyMongoError as e:
+                logging.error(f"Failed to log {len(logs)} broadcast messages: {e}")
+        return len(logs)
+
+    contacts_cursor = db.contacts.find(query, {"_id": 1, "phone_number": 1}).batch_size(BROADCAST_BATCH_SIZE)
+    batch = []
     async for contact in contacts_cursor:
-        try:
-            await send_whatsapp_reply(contact["phone_number"], message)
-            await log_message(db, contact["_id"], contact["phone_number"], "outbound", f"[BROADCAST] {message}")
-            total_sent += 1
-            await asyncio.sleep(0.1) 
-        except Exception as e:
-            logging.error(f"Failed to send broadcast to {contact['phone_number']}: {e}")
-            
+        batch.append(contact)
+        if len(batch) == BROADCAST_BATCH_SIZE:
+            total_sent += await send_batch(batch)
+            batch = []
+    if batch:
+        total_sent += await send_batch(batch)
+
     logging.info(f"Broadcast task complete. Sent {total_sent} messages.")
+    return total_sent
+
+# --- Broadcast Worker (Celery) ---
+# Run with: celery -A main.celery_app worker
+celery_app = Celery("chatflow", broker=REDIS_URL, backend=REDIS_URL) if REDIS_URL else None
+
+def run_broadcast_in_worker(message: str, tags: List[str]) -> int:
+    """Runs a broadcast on a Celery worker with its own event loop, Mongo client and HTTP client."""
+    async def run() -> int:
+        # Task-local clients: concurrent tasks (thread/gevent pools) never share or close each other's
+        client = AsyncIOMotorClient(MONGO_URI, tz_aware=True)
+        http = create_whatsapp_http_client() if WHATSAPP_API_URL else None
+        try:
+            return await run_broadcast_task(client[MONGO_DB_NAME], http, message, tags)
+        finally:
+            if http is not None:
+                await http.aclose()
+            client.close()
+    return asyncio.run(run())
+
+if celery_app:
+    run_broadcast_task_celery = celery_app.task(name="chatflow.broadcast")(run_broadcast_in_worker)
 
 @app.post("/api/broadcast")
 async def send_broadcast_message(
     request: BroadcastRequest,
     background_tasks: BackgroundTasks, 
-    db: AsyncIOMotorDatabase = Depends(get_database)
+    db: AsyncIOMotorDatabase = Depends(get_database),
+    http: Optional[httpx.AsyncClient] = Depends(get_http_client)
 ):
     logging.info(f"Received broadcast request: {request.message[:20]}...")
-    background_tasks.add_task(run_broadcast_task, db, request.message, request.tags)
-    return {"status": "ok", "message": "Broadcast task started in background.", "total_sent": 0}
+    if celery_app:
+        task = run_broadcast_task_celery.delay(request.message, request.tags)
+        return {"status": "ok", "message": "Broadcast task queued.", "task_id": task.id, "total_sent": 0}
+    background_tasks.add_task(run_broadcast_task, db, http, request.message, request.tags)
+    return {"status": "ok", "message": "Broadcast task started in background.", "task_id": None, "total_sent": 0}
+
+@app.get("/api/broadcast/{task_id}")
+def get_broadcast_status(task_id: str):
+    if celery_app is None:
+        raise HTTPException(status_code=404, detail="Broadcast status tracking is not enabled.")
+    result = AsyncResult(task_id, app=celery_app)
+    total_sent = result.result if result.successful() else 0
+    return {"task_id": task_id, "state": result.state, "total_sent": total_sent}
 
 # --- WhatsApp Webhook Endpoint (FIXED) ---
 class WebhookMessage(BaseModel):
@@ -360,11 +775,13 @@ class WebhookPayload(BaseModel):
 @app.post("/api/webhook/whatsapp")
 async def handle_whatsapp_webhook(
     payload: WebhookPayload = Body(...), 
-    db: AsyncIOMotorDatabase = Depends(get_database)
+    db: AsyncIOMotorDatabase = Depends(get_database),
+    http: Optional[httpx.AsyncClient] = Depends(get_http_client)
 ):
     message = payload.messages[0]
     from_number = message.from_number
     text = message.text
+    now = utc_now()
 
     contact = await db.contacts.find_one({"phone_number": from_number})
     if not contact:
@@ -373,42 +790,37 @@ async def handle_whatsapp_webhook(
             "phone_number": from_number, 
             "tags": ["new_lead"],
             "current_flow_node_id": None, 
-            "last_active": datetime.datetime.utcnow()
+            "last_active": now
         }
-        new_contact_result = await db.contacts.insert_one(new_contact_data)
-        contact = await db.contacts.find_one({"_id": new_contact_result.inserted_id})
+        try:
+            new_contact_result = await db.contacts.insert_one(new_contact_data)
+            new_contact_data["_id"] = new_contact_result.inserted_id
+            contact = new_contact_data
+        except DuplicateKeyError:
+            # A concurrent webhook created this contact first
+            contact = await db.contacts.find_one({"phone_number": from_number})
     
-    contact = ContactInDB(**contact)
-    await log_message(db, contact.id, from_number, "inbound", text)
-    active_flow = await db.flows.find_one({"is_active": True})
+    contact = construct_from_db(ContactInDB, contact)
+    log_message(contact.id, from_number, "inbound", text, now)
+    active_flow, flow_index = await get_active_flow(db)
     
     if not active_flow:
         logging.warning(f"No active flow for inbound message from {from_number}.")
         return {"status": "ok", "message": "No active flow."}
         
-    flow_data = active_flow.get('flow_data', {})
-    nodes = flow_data.get('nodes', [])
     current_node_id = contact.current_flow_node_id
     
-    # ✅ FIXED: Changed "current_.node" to "current_node"
-    current_node = next(
-        (n for n in nodes if n.get('id') == current_node_id), 
-        None
-    ) if current_node_id else None
+    current_node = flow_index["nodes_by_id"].get(current_node_id) if current_node_id else None
 
     if not current_node:
-        target_nodes = {edge.get('target') for edge in flow_data.get('edges', [])}
-        trigger_node = next(
-            (n for n in nodes if n.get('id') not in target_nodes), 
-            None
-        )
+        trigger_node = flow_index["trigger"]
         
         if not trigger_node:
             logging.error(f"Active flow {active_flow['name']} has no trigger node.")
             return {"status": "ok", "message": "No trigger node found."}
         current_node = trigger_node
 
-    await execute_flow_node(db, contact, current_node, flow_data)
+    await execute_flow_node(db, http, contact, current_node, flow_index)
     return {"status": "ok", "message_processed": True}
 
 
@@ -416,30 +828,14 @@ async def handle_whatsapp_webhook(
 @app.get("/api/dashboard/stats", response_model=DashboardStats)
 async def get_dashboard_stats(db: AsyncIOMotorDatabase = Depends(get_database)):
     
-    # 1. Get total contacts
-    total_contacts = await db.contacts.count_documents({})
+    # Mongo stores (and $dateToString buckets) timestamps in UTC, so the windows must be UTC too
+    now = utc_now()
+    thirty_days_ago = now - timedelta(days=30)
+    chart_dates = [now.date() - timedelta(days=6 - i) for i in range(7)]
+    seven_days_ago = datetime.datetime.combine(chart_dates[0], datetime.time.min, tzinfo=datetime.UTC)
     
-    # 2. Get new contacts in the last 30 days
-    thirty_days_ago = datetime.datetime.now() - timedelta(days=30)
-    new_contacts_30_days = await db.contacts.count_documents(
-        {"_id": {"$gte": ObjectId.from_datetime(thirty_days_ago)}}
-    )
-    
-    # 3. Get message counts
-    total_messages_in = await db.message_logs.count_documents({"direction": "inbound"})
-    total_messages_out = await db.message_logs.count_documents({"direction": "outbound"})
-    
-    # 4. Calculate Automation Success Rate (Outbound / Inbound)
-    automation_success_rate = 0.0
-    if total_messages_in > 0:
-        automation_success_rate = (total_messages_out / total_messages_in) * 100
-    
-    # 5. Get Chart Data (Last 7 Days)
-    seven_days_ago = datetime.datetime.now().replace(
-        hour=0, minute=0, second=0, microsecond=0
-    ) - timedelta(days=6)
-    
-    # MongoDB aggregation pipeline for chart data
+    # MongoDB aggregation pipeline for chart data; the leading $match uses the timestamp index
+    # (indexes are never used inside $facet, so the counts stay separate queries)
     pipeline = [
         {
             "$match": {
@@ -450,7 +846,7 @@ async def get_dashboard_stats(db: AsyncIOMotorDatabase = Depends(get_database)):
             "$group": {
                 "_id": {
                     "date": {
-                        "$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}
+                        "$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp", "timezone": "UTC"}
                     },
                     "direction": "$direction"
                 },
@@ -487,18 +883,34 @@ async def get_dashboard_stats(db: AsyncIOMotorDatabase = Depends(get_database)):
         }
     ]
     
-    chart_data_cursor = db.message_logs.aggregate(pipeline)
-    chart_data_list = await chart_data_cursor.to_list(length=7)
+    # All five reads are independent; run them concurrently for a single round trip of wall time
+    (
+        total_contacts,
+        new_contacts_30_days,
+        total_messages_in,
+        total_messages_out,
+        chart_data_list,
+    ) = await asyncio.gather(
+        db.contacts.count_documents({}),
+        db.contacts.count_documents({"_id": {"$gte": ObjectId.from_datetime(thirty_days_ago)}}),
+        db.message_logs.count_documents({"direction": "inbound"}),
+        db.message_logs.count_documents({"direction": "outbound"}),
+        db.message_logs.aggregate(pipeline).to_list(length=7),
+    )
+    
+    # Calculate Automation Success Rate (Outbound / Inbound)
+    automation_success_rate = 0.0
+    if total_messages_in > 0:
+        automation_success_rate = (total_messages_out / total_messages_in) * 100
     
-    # Fill in missing dates
-    chart_data_dict = {item['date']: item for item in chart_data_list}
-    final_chart_data = []
-    for i in range(7):
-        date = (seven_days_ago + timedelta(days=i)).strftime("%Y-%m-%d")
-        if date in chart_data_dict:
-            final_chart_data.append(chart_data_dict[date])
-        else:
-            final_chart_data.append({"date": date, "inbound": 0, "outbound": 0})
+    # Fill in missing dates: start from a zeroed 7-day skeleton and overlay the aggregated rows
+    chart_template = {
+        d.isoformat(): {"date": d.isoformat(), "inbound": 0, "outbound": 0} for d in chart_dates
+    }
+    for row in chart_data_list:
+        if row['date'] in chart_template:
+            chart_template[row['date']].update(inbound=row['inbound'], outbound=row['outbound'])
+    final_chart_data = list(chart_template.values())
 
     return DashboardStats(
         total_contacts=total_contacts,
@@ -511,10 +923,24 @@ async def get_dashboard_stats(db: AsyncIOMotorDatabase = Depends(get_database)):
 
 # --- Run the application ---
 if __name__ == "__main__":
-    logging.info("Starting FastAPI server for development...")
-    # uvicorn.run(
-    #     "main:app",
-    #     host="0.0.0.0",
-    #     port=8000,
-    #     reload=True
-    # )
\ No newline at end of file
+    dev_mode = os.environ.get("DEV") == "1"
+    if dev_mode:
+        logging.info("Starting FastAPI server for development...")
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            reload=True
+        )
+    else:
+        # Production: uvloop + httptools, one worker per core (2*cpu+1 by default), no file watcher
+        workers = int(os.environ.get("WEB_CONCURRENCY", 2 * (os.cpu_count() or 1) + 1))
+        logging.info(f"Starting FastAPI server with {workers} workers...")
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=int(os.environ.get("PORT", "8000")),
+            loop="uvloop",
+            http="httptools",
+            workers=workers
+        )
@@ -0,0 +1,132 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from pymongo import WriteConcern
+from pymongo.errors import OperationFailure
+
+# main.py lives in backend/, one level above the tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def matches(document, query):
+    """Evaluates the small subset of Mongo query syntax the app uses."""
+    for field, condition in (query or {}).items():
+        value = document.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for op, arg in condition.items():
+            if op == "$gte" and not (value is not None and value >= arg):
+                return False
+            if op == "$ne" and value == arg:
+                return False
+            if op == "$in" and value not in arg:
+                return False
+            if op == "$nin" and value in arg:
+                return False
+    return True
+
+
+class FakeCursor:
+    """Stand-in for a Motor cursor over a fixed list of documents."""
+
+    def __init__(self, documents):
+        self.documents = list(documents)
+
+    def batch_size(self, size):
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+    async def to_list(self, length=None):
+        return self.documents[:length] if length is not None else list(self.documents)
+
+
+class FakeCollection:
+    """In-memory stand-in for a Motor collection.
+
+    Queries run against `documents`; `aggregate` returns the canned `aggregate_results`
+    and records the pipeline. Handles from `get_collection` share storage, like Motor's.
+    """
+
+    def __init__(self, name, write_concern=None, storage=None):
+        self.name = name
+        self.write_concern = write_concern or WriteConcern()
+        storage = storage or {"documents": [], "aggregate_results": [], "pipelines": [], "write_concerns": []}
+        self._storage = storage
+        self.documents = storage["documents"]
+        self.pipelines = storage["pipelines"]
+        self.write_concerns = storage["write_concerns"]
+
+    @property
+    def aggregate_results(self):
+        return self._storage["aggregate_results"]
+
+    @aggregate_results.setter
+    def aggregate_results(self, results):
+        self._storage["aggregate_results"] = results
+
+    def with_write_concern(self, write_concern):
+        return FakeCollection(self.name, write_concern, self._storage)
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(d for d in self.documents if matches(d, query))
+
+    async def find_one(self, query=None):
+        return next((d for d in self.documents if matches(d, query)), None)
+
+    async def count_documents(self, query):
+        return sum(1 for d in self.documents if matches(d, query))
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return FakeCursor(self.aggregate_results)
+
+    async def update_one(self, query, update):
+        document = next((d for d in self.documents if matches(d, query)), None)
+        if document is not None:
+            document.update(update.get("$set", {}))
+
+    async def insert_many(self, documents, ordered=True, bypass_document_validation=False):
+        # Mirrors pymongo's bulk.execute_no_results check for w=0 writes
+        if not self.write_concern.acknowledged and bypass_document_validation:
+            raise OperationFailure("Cannot set bypass_document_validation with unacknowledged write concern")
+        self.write_concerns.append(self.write_concern)
+        self.documents.extend(documents)
+
+
+class FakeDatabase:
+    """Stand-in for a Motor database; collections are created on first access."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._collections.setdefault(name, FakeCollection(name))
+
+    def get_collection(self, name, write_concern=None):
+        return getattr(self, name).with_write_concern(write_concern)
+
+
+@pytest.fixture
+def fake_db():
+    return FakeDatabase()
+
+
+@pytest.fixture
+def fresh_log_queue(monkeypatch):
+    """Gives each test its own log queue and pending index (queues bind to one event loop)."""
+    monkeypatch.setitem(main.app_state, "log_queue", asyncio.Queue())
+    monkeypatch.setitem(main.app_state, "pending_logs", {})
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+import main
+
+ACTIVE_FLOW = {"name": "Welcome", "is_active": True, "flow_data": {"nodes": [{"id": "start"}], "edges": []}}
+
+
+@pytest.fixture
+def fresh_flow_cache(monkeypatch):
+    monkeypatch.setitem(main.app_state, "active_flow_cache", {"data": None, "index": None, "expires": 0.0, "version": 0})
+    monkeypatch.setitem(main.app_state, "active_flow_lock", asyncio.Lock())
+
+
+def count_reads(monkeypatch, fake_db, before_return=None):
+    reads = []
+
+    async def find_one(query):
+        reads.append(query)
+        if before_return:
+            await before_return()
+        return ACTIVE_FLOW
+
+    monkeypatch.setattr(fake_db.flows, "find_one", find_one)
+    return reads
+
+
+def test_active_flow_is_read_once_per_ttl(monkeypatch, fake_db, fresh_flow_cache):
+    reads = count_reads(monkeypatch, fake_db)
+
+    async def scenario():
+        first = await main.get_active_flow(fake_db)
+        second = await main.get_active_flow(fake_db)
+        return first, second
+
+    (flow, index), (cached_flow, cached_index) = asyncio.run(scenario())
+
+    assert len(reads) == 1
+    assert cached_flow is flow and cached_index is index
+    assert index["trigger"] == {"id": "start"}
+
+
+def test_invalidation_forces_a_reread(monkeypatch, fake_db, fresh_flow_cache):
+    reads = count_reads(monkeypatch, fake_db)
+
+    async def scenario():
+        await main.get_active_flow(fake_db)
+        main.invalidate_active_flow_cache()
+        await main.get_active_flow(fake_db)
+
+    asyncio.run(scenario())
+
+    assert len(reads) == 2
+
+
+def test_read_racing_an_invalidation_is_not_cached(monkeypatch, fake_db, fresh_flow_cache):
+    async def invalidate_mid_read():
+        # A flow mutation lands while the refresh is still waiting on Mongo
+        main.invalidate_active_flow_cache()
+
+    reads = count_reads(monkeypatch, fake_db, before_return=invalidate_mid_read)
+
+    async def scenario():
+        flow, _ = await main.get_active_flow(fake_db)
+        assert flow is ACTIVE_FLOW
+        assert main.app_state["active_flow_cache"]["expires"] == 0.0
+        await main.get_active_flow(fake_db)
+
+    asyncio.run(scenario())
+
+    # The stale read was served once but never cached, so the next call re-queries
+    assert len(reads) == 2
@@ -0,0 +1,40 @@
+import asyncio
+
+from bson import ObjectId
+
+import main
+
+
+def test_chat_history_includes_unflushed_logs(fake_db, fresh_log_queue):
+    contact_id = ObjectId()
+    # The bot's previous reply and the new inbound message are both still queued
+    reply = main.log_message(contact_id, "+15550001", "outbound", "How can I help?", main.utc_now())
+    inbound = main.log_message(contact_id, "+15550001", "inbound", "Book a haircut", main.utc_now())
+    fake_db.message_logs.aggregate_results = [{"role": "user", "content": "Hi"}]
+
+    history = asyncio.run(main.get_chat_history(fake_db, contact_id))
+
+    assert history == [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "How can I help?"},
+        {"role": "user", "content": "Book a haircut"},
+    ]
+    [pipeline] = fake_db.message_logs.pipelines
+    assert pipeline[0]["$match"]["_id"] == {"$nin": [reply["_id"], inbound["_id"]]}
+
+
+def test_chat_history_limit_counts_unflushed_logs(fake_db, fresh_log_queue):
+    contact_id = ObjectId()
+    main.log_message(contact_id, "+15550001", "inbound", "Latest", main.utc_now())
+    fake_db.message_logs.aggregate_results = [{"role": "assistant", "content": "Older"}]
+
+    history = asyncio.run(main.get_chat_history(fake_db, contact_id, limit=1))
+
+    assert history == [{"role": "user", "content": "Latest"}]
+    [pipeline] = fake_db.message_logs.pipelines
+    assert {"$limit": 1} in pipeline
+
+
+def test_chat_history_without_room_skips_the_query(fake_db, fresh_log_queue):
+    assert asyncio.run(main.get_chat_history(fake_db, ObjectId(), limit=0)) == []
+    assert fake_db.message_logs.pipelines == []
@@ -0,0 +1,27 @@
+import asyncio
+
+from bson import ObjectId
+
+import main
+
+
+def test_dashboard_counts_and_chart_use_indexable_queries(fake_db):
+    fake_db.contacts.documents.extend({"_id": ObjectId()} for _ in range(3))
+    fake_db.message_logs.documents.extend(
+        [{"direction": "inbound"}] * 4 + [{"direction": "outbound"}] * 3
+    )
+    today = main.utc_now().date().isoformat()
+    fake_db.message_logs.aggregate_results = [{"date": today, "inbound": 4, "outbound": 3}]
+
+    stats = asyncio.run(main.get_dashboard_stats(fake_db))
+
+    assert (stats.total_contacts, stats.new_contacts_30_days) == (3, 3)
+    assert (stats.total_messages_in, stats.total_messages_out) == (4, 3)
+    assert stats.automation_success_rate == 75.0
+    assert [point.date for point in stats.chart_data][-1] == today
+    assert len(stats.chart_data) == 7
+    assert (stats.chart_data[-1].inbound, stats.chart_data[0].inbound) == (4, 0)
+    # The chart must lead with the timestamp $match so it can use the index ($facet never does)
+    [pipeline] = fake_db.message_logs.pipelines
+    assert list(pipeline[0]) == ["$match"] and "timestamp" in pipeline[0]["$match"]
+    assert not any("$facet" in stage for stage in pipeline)
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+
+import main
+
+FLOW_INDEX = main.build_flow_index({
+    "nodes": [
+        {"id": "start", "type": "textMessage", "data": {"message": "Welcome!"}},
+        {"id": "next", "type": "textMessage", "data": {"message": "Pick a service"}},
+    ],
+    "edges": [{"source": "start", "target": "next"}],
+})
+
+
+def add_contact(fake_db, current_flow_node_id):
+    doc = {
+        "_id": ObjectId(),
+        "name": "Ana",
+        "phone_number": "+14155550100",
+        "tags": [],
+        "current_flow_node_id": current_flow_node_id,
+        "last_active": main.utc_now(),
+    }
+    fake_db.contacts.documents.append(doc)
+    return doc
+
+
+def test_successful_reply_is_logged_and_advances_the_contact(monkeypatch, fake_db, fresh_log_queue):
+    async def send(http, phone_number, text):
+        pass
+
+    monkeypatch.setattr(main, "send_whatsapp_reply", send)
+    doc = add_contact(fake_db, None)
+    contact = main.construct_from_db(main.ContactInDB, doc)
+
+    asyncio.run(main.execute_flow_node(fake_db, None, contact, FLOW_INDEX["nodes_by_id"]["start"], FLOW_INDEX))
+
+    assert doc["current_flow_node_id"] == "next"
+    [log] = main.app_state["pending_logs"][doc["_id"]]
+    assert (log["direction"], log["text"]) == ("outbound", "Welcome!")
+
+
+def test_failed_reply_leaves_the_contact_on_the_same_node(monkeypatch, fake_db, fresh_log_queue):
+    async def send(http, phone_number, text):
+        raise RuntimeError("WhatsApp API unavailable")
+
+    monkeypatch.setattr(main, "send_whatsapp_reply", send)
+    doc = add_contact(fake_db, None)
+    contact = main.construct_from_db(main.ContactInDB, doc)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main.execute_flow_node(fake_db, None, contact, FLOW_INDEX["nodes_by_id"]["start"], FLOW_INDEX))
+
+    # A retried delivery must re-run "start" rather than skip to "next"
+    assert doc["current_flow_node_id"] is None
+    assert main.app_state["pending_logs"] == {}
@@ -0,0 +1,25 @@
+import main
+
+
+def test_flow_index_maps_nodes_and_follows_the_first_edge():
+    start = {"id": "start", "type": "textMessage"}
+    menu = {"id": "menu", "type": "textMessage"}
+    fallback = {"id": "fallback", "type": "textMessage"}
+    index = main.build_flow_index({
+        "nodes": [menu, start, fallback],
+        "edges": [
+            {"source": "start", "target": "menu"},
+            {"source": "start", "target": "fallback"},
+        ],
+    })
+
+    assert index["nodes_by_id"] == {"start": start, "menu": menu, "fallback": fallback}
+    # Matches the original linear scan, which stopped at the first outgoing edge
+    assert index["next_of"] == {"start": "menu"}
+    assert index["trigger"] is start
+
+
+def test_flow_index_handles_an_empty_flow():
+    index = main.build_flow_index({})
+
+    assert index == {"nodes_by_id": {}, "next_of": {}, "trigger": None}
@@ -0,0 +1,72 @@
+import asyncio
+
+from bson import ObjectId
+
+import main
+
+
+def test_flusher_writes_queued_logs_acknowledged(monkeypatch, fake_db, fresh_log_queue):
+    async def scenario():
+        monkeypatch.setattr(main, "LOG_FLUSH_INTERVAL", 0.01)
+        contact_id = ObjectId()
+        logs = [
+            main.log_message(contact_id, "+15550001", "inbound", "hello", main.utc_now()),
+            main.log_message(contact_id, "+15550001", "outbound", "world", main.utc_now()),
+        ]
+
+        flusher = asyncio.create_task(main.run_message_log_flusher(fake_db))
+        await asyncio.sleep(0.05)
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+        return logs
+
+    logs = asyncio.run(scenario())
+    assert fake_db.message_logs.documents == logs
+    assert [wc.acknowledged for wc in fake_db.message_logs.write_concerns] == [True]
+    # Only forgotten once the acknowledged write has returned
+    assert main.app_state["pending_logs"] == {}
+
+
+def test_flusher_writes_batch_in_hand_on_shutdown(monkeypatch, fake_db, fresh_log_queue):
+    async def scenario():
+        monkeypatch.setattr(main, "LOG_FLUSH_INTERVAL", 60)
+        log = main.log_message(ObjectId(), "+15550001", "inbound", "bye", main.utc_now())
+
+        flusher = asyncio.create_task(main.run_message_log_flusher(fake_db))
+        # The flusher is now waiting for more logs with one already in its batch
+        await asyncio.sleep(0.01)
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+        return log
+
+    log = asyncio.run(scenario())
+    assert fake_db.message_logs.documents == [log]
+
+
+def test_logs_stay_pending_until_their_write_returns(monkeypatch, fake_db, fresh_log_queue):
+    async def scenario():
+        monkeypatch.setattr(main, "LOG_FLUSH_INTERVAL", 0.01)
+        write_started, release_write = asyncio.Event(), asyncio.Event()
+        insert_many = fake_db.message_logs.insert_many
+
+        async def slow_insert_many(documents, **kwargs):
+            write_started.set()
+            await release_write.wait()
+            await insert_many(documents, **kwargs)
+
+        monkeypatch.setattr(fake_db.message_logs, "insert_many", slow_insert_many)
+        contact_id = ObjectId()
+        main.log_message(contact_id, "+15550001", "outbound", "See you at 5", main.utc_now())
+
+        flusher = asyncio.create_task(main.run_message_log_flusher(fake_db))
+        await write_started.wait()
+        in_flight = await main.get_chat_history(fake_db, contact_id)
+        release_write.set()
+        await asyncio.sleep(0.01)
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+        return in_flight
+
+    in_flight = asyncio.run(scenario())
+    assert in_flight == [{"role": "assistant", "content": "See you at 5"}]
+    assert main.app_state["pending_logs"] == {}
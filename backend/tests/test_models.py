@@ -0,0 +1,14 @@
+import pytest
+from pydantic import ValidationError
+
+import main
+
+
+def test_contact_create_accepts_e164_phone_number():
+    assert main.ContactCreate(name="Ana", phone_number="+14155550100").phone_number == "+14155550100"
+
+
+@pytest.mark.parametrize("phone_number", ["+1234567\n", "abc", "+0123456", "+1"])
+def test_contact_create_rejects_invalid_phone_number(phone_number):
+    with pytest.raises(ValidationError):
+        main.ContactCreate(name="Ana", phone_number=phone_number)
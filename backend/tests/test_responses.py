@@ -0,0 +1,32 @@
+import warnings
+
+import pytest
+from bson import ObjectId
+from fastapi.exceptions import FastAPIDeprecationWarning
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def client(fake_db):
+    main.app.dependency_overrides[main.get_database] = lambda: fake_db
+    # Not entered as a context manager, so lifespan (and its Mongo connection) doesn't run
+    yield TestClient(main.app)
+    main.app.dependency_overrides.clear()
+
+
+def test_flow_and_dashboard_responses_avoid_deprecated_response_classes(client, fake_db):
+    flow_id = ObjectId()
+    fake_db.flows.documents.append({"_id": flow_id, "name": "Welcome", "flow_data": {"nodes": []}, "is_active": True})
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", FastAPIDeprecationWarning)
+        flow = client.get(f"/api/flows/{flow_id}")
+        stats = client.get("/api/dashboard/stats")
+
+    assert flow.status_code == 200
+    assert flow.headers["content-type"] == "application/json"
+    assert flow.json() == {"id": str(flow_id), "name": "Welcome", "flow_data": {"nodes": []}, "is_active": True}
+    assert stats.status_code == 200
+    assert len(stats.json()["chart_data"]) == 7
@@ -0,0 +1,33 @@
+import asyncio
+import datetime
+
+import orjson
+from bson import ObjectId
+from bson.tz_util import utc
+
+import main
+
+
+async def collect(stream):
+    return b"".join([chunk async for chunk in stream])
+
+
+def test_streamed_contacts_match_created_contact_timestamps(fake_db):
+    # tz_aware Motor clients return UTC datetimes carrying bson's utc tzinfo
+    last_active = datetime.datetime(2026, 10, 15, 12, 0, 0, 123000, tzinfo=utc)
+    doc = {
+        "_id": ObjectId(),
+        "name": "Ana",
+        "phone_number": "+14155550100",
+        "tags": [],
+        "current_flow_node_id": None,
+        "last_active": last_active,
+    }
+    fake_db.contacts.documents.append(doc)
+
+    body = asyncio.run(collect(main.stream_json_array(fake_db.contacts.find(), main.contact_to_json)))
+    created = main.construct_from_db(main.ContactInDB, doc).model_dump(mode="json")
+
+    [streamed] = orjson.loads(body)
+    assert streamed["_id"] == str(doc["_id"])
+    assert streamed["last_active"] == created["last_active"] == "2026-10-15T12:00:00.123000Z"